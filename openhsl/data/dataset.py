@@ -25,11 +25,10 @@ def get_dataset(hsi: HSImage, mask: Optional[HSMask] = None) -> Tuple[np.ndarray
     """
     ignored_labels = [0]
 
-    for n, ch in enumerate(hsi):
-        if np.all(np.unique(ch) == [0]):
-            print(f"WARNING! {n}-CHANNEL HAS NO VALID DATA! ONLY ZEROS IN DATA!")
-        else:
-            continue
+    # one reduction over the whole cube instead of sorting every channel with np.unique
+    empty_channels = np.where(~hsi.data.any(axis=(0, 1)))[0]
+    for n in empty_channels:
+        print(f"WARNING! {n}-CHANNEL HAS NO VALID DATA! ONLY ZEROS IN DATA!")
 
     img = hsi.data
 
@@ -41,5 +40,6 @@ def get_dataset(hsi: HSImage, mask: Optional[HSMask] = None) -> Tuple[np.ndarray
         gt = None
         label_values = [0]
 
-    img = standardize_input_data(img).astype('float32')
+    # standardize_input_data already emits float32, no extra cast pass needed
+    img = standardize_input_data(img)
     return img, gt
@@ -1,8 +1,9 @@
-import random
 import scipy
 import numpy as np
 import scipy.ndimage
 
+from numpy.lib.stride_tricks import sliding_window_view
+
 from sklearn import preprocessing
 from sklearn.model_selection import train_test_split
 from typing import Optional, Dict
@@ -39,42 +40,42 @@ def create_patches(X: np.ndarray,
 
     margin = int((patch_size - 1) / 2)
     zero_padded_X = pad_with_zeros(X, margin=margin)
-    # split patches
-    patches_data = np.zeros((X.shape[0] * X.shape[1], patch_size, patch_size, X.shape[2]))
-    patches_labels = np.zeros((X.shape[0] * X.shape[1]))
-
-    patch_index = 0
-    for r in range(margin, zero_padded_X.shape[0] - margin):
-        for c in range(margin, zero_padded_X.shape[1] - margin):
-            patch = zero_padded_X[r - margin:r + margin + 1, c - margin:c + margin + 1]
-            patches_data[patch_index, :, :, :] = patch
-            patches_labels[patch_index] = y[r - margin, c - margin]
-            patch_index = patch_index + 1
+    # all patches as a zero-copy view over the padded cube: (H, W, 1, patch_size, patch_size, bands)
+    windows = sliding_window_view(zero_padded_X, (patch_size, patch_size, X.shape[2]))
+    patches_labels = y.ravel().astype(np.float64)
 
     if remove_zero_labels:
-        patches_data = patches_data[patches_labels > 0, :, :, :]
-        patches_labels = patches_labels[patches_labels > 0]
+        # only patches with non-zero labels are materialized as a copy
+        keep = patches_labels > 0
+        patches_data = np.ascontiguousarray(windows[keep.reshape(y.shape)][:, 0])
+        patches_labels = patches_labels[keep]
         patches_labels -= 1
+    else:
+        patches_data = np.ascontiguousarray(windows.reshape(-1, patch_size, patch_size, X.shape[2]))
 
     return patches_data, patches_labels
 # ----------------------------------------------------------------------------------------------------------------------
 
 
 def augment_data(X_train: np.ndarray):
-    for i in range(int(X_train.shape[0] / 2)):
-        patch = X_train[i, :, :, :]
-        num = random.randint(0, 2)
-        if num == 0:
-            flipped_patch = np.flipud(patch)
-        if num == 1:
-            flipped_patch = np.fliplr(patch)
-        if num == 2:
-            no = random.randrange(-180, 180, 30)
-            flipped_patch = scipy.ndimage.interpolation.rotate(patch, no, axes=(1, 0),
-                                                               reshape=False, output=None, order=3, mode='constant',
-                                                               cval=0.0, prefilter=False)
-        patch2 = flipped_patch
-        X_train[i, :, :, :] = patch2
+    half = int(X_train.shape[0] / 2)
+    nums = np.random.randint(0, 3, size=half)
+
+    flip_ud = np.where(nums == 0)[0]
+    X_train[flip_ud] = X_train[flip_ud, ::-1, :, :]
+
+    flip_lr = np.where(nums == 1)[0]
+    X_train[flip_lr] = X_train[flip_lr, :, ::-1, :]
+
+    # rotations only use 12 discrete angles, so patches are rotated
+    # grouped by angle instead of one scipy call per patch
+    to_rotate = np.where(nums == 2)[0]
+    angles = np.random.choice(np.arange(-180, 180, 30), size=len(to_rotate))
+    for angle in np.unique(angles):
+        idx = to_rotate[angles == angle]
+        X_train[idx] = scipy.ndimage.rotate(X_train[idx], angle, axes=(2, 1),
+                                            reshape=False, output=None, order=3, mode='constant',
+                                            cval=0.0, prefilter=False)
 
     return X_train
 # ----------------------------------------------------------------------------------------------------------------------
@@ -93,26 +94,14 @@ def preprocess_data(X: np.ndarray,
 
     X_train, X_val, y_train, y_val = split_train_test_set(X_train, y_train, 0.1)
 
-    X_train = np.reshape(X_train, (X_train.shape[0], X_train.shape[3], X_train.shape[1], X_train.shape[2]))
+    # patches stay channels-last, matching the network input layout
     y_train = np_utils.to_categorical(y_train)
-
-    X_val = np.reshape(X_val, (X_val.shape[0], X_val.shape[3], X_val.shape[1], X_val.shape[2]))
     y_val = np_utils.to_categorical(y_val)
 
     return X_train, X_val, y_train, y_val
 # ----------------------------------------------------------------------------------------------------------------------
 
 
-def get_data_generator(X: np.ndarray,
-                       y: np.ndarray,
-                       epochs: int):
-    for _ in range(epochs):
-        train_generator = zip(X, y)
-        for (img, mask) in train_generator:
-            yield img, mask
-# ----------------------------------------------------------------------------------------------------------------------
-
-
 def get_patch_by_indicis(data: np.array,
                          height_index: int,
                          width_index: int,
@@ -124,18 +113,3 @@ def get_patch_by_indicis(data: np.array,
 
     return patch
 # ----------------------------------------------------------------------------------------------------------------------
-
-
-def get_test_generator(X: np.array,
-                       patch_size: int):
-    X = pad_with_zeros(X, patch_size // 2)
-    height = X.shape[0]
-    width = X.shape[1]
-    for i in range(0, height - patch_size + 1):
-        for j in range(0, width - patch_size + 1):
-            image_patch = get_patch_by_indicis(X, i, j, patch_size)
-            image_patch = image_patch.reshape(image_patch.shape[2],
-                                              image_patch.shape[0],
-                                              image_patch.shape[1]).astype('float32')
-            yield image_patch
-# ----------------------------------------------------------------------------------------------------------------------
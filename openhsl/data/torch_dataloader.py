@@ -1,3 +1,4 @@
+import os
 import torch
 import torch.utils
 import torch.utils.data
@@ -12,7 +13,23 @@ def create_loader(img: np.array,
                   hyperparams: Dict,
                   shuffle: Any = False):
     dataset = DataLoader(img, gt, **hyperparams)
-    return udata.DataLoader(dataset, batch_size=hyperparams["batch_size"], shuffle=shuffle)
+    # assemble patches in parallel worker processes instead of the training process
+    num_workers = hyperparams.get("num_workers", os.cpu_count())
+    # pinned host memory makes the H2D copy async-capable, so .to(device,
+    # non_blocking=True) in the loops overlaps with compute
+    pin_memory = hyperparams.get("pin_memory", torch.cuda.is_available())
+    # under torch.distributed every rank gets its own shard of the dataset
+    sampler = None
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        sampler = udata.distributed.DistributedSampler(dataset, shuffle=bool(shuffle))
+        shuffle = False
+    return udata.DataLoader(dataset,
+                            batch_size=hyperparams["batch_size"],
+                            shuffle=shuffle,
+                            sampler=sampler,
+                            num_workers=num_workers,
+                            persistent_workers=num_workers > 0,
+                            pin_memory=pin_memory)
 
 
 class DataLoader(torch.utils.data.Dataset):
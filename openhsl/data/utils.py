@@ -5,7 +5,6 @@ import numpy as np
 import sklearn.model_selection
 import seaborn as sns
 from typing import Tuple
-from sklearn.decomposition import PCA
 
 
 def is_coordinate_in_padded_area(coordinates: Tuple,
@@ -40,11 +39,18 @@ def apply_pca(X: np.ndarray,
 
     """
     print(f'Will apply PCA from {X.data.shape[-1]} to {num_components}')
-    newX = np.reshape(X, (-1, X.shape[2]))
-    pca = PCA(n_components=num_components, whiten=True, random_state=131)
-    newX = pca.fit_transform(newX)
+    newX = np.reshape(X, (-1, X.shape[2])).astype(np.float64)
+    newX -= newX.mean(axis=0)
+    # snapshot PCA: eigendecomposition of the small (bands, bands) covariance
+    # instead of an SVD of the full (H*W, bands) matrix
+    cov = (newX.T @ newX) / (newX.shape[0] - 1)
+    eig_vals, eig_vecs = np.linalg.eigh(cov)
+    order = eig_vals.argsort()[::-1][:num_components]
+    components = eig_vecs[:, order]
+    # project and whiten, as the previous PCA(whiten=True) did
+    newX = (newX @ components) / np.sqrt(eig_vals[order])
     newX = np.reshape(newX, (X.shape[0], X.shape[1], num_components))
-    return newX, pca
+    return newX, components
 # ----------------------------------------------------------------------------------------------------------------------
 
 
@@ -59,7 +65,9 @@ def pad_with_zeros(X: np.ndarray,
     Returns:
 
     """
-    newX = np.zeros((X.shape[0] + 2 * margin, X.shape[1] + 2 * margin, X.shape[2]))
+    # keep the input dtype: the old float64 default silently quadrupled the
+    # footprint of uint8/float32 cubes
+    newX = np.zeros((X.shape[0] + 2 * margin, X.shape[1] + 2 * margin, X.shape[2]), dtype=X.dtype)
     x_offset = margin
     y_offset = margin
     newX[x_offset:X.shape[0] + x_offset, y_offset:X.shape[1] + y_offset, :] = X
@@ -81,10 +89,21 @@ def standardize_input_data(data: np.ndarray) -> np.ndarray:
         -------
         np.ndarray
     """
-    data_new = np.zeros(np.shape(data))
-    for i in range(data.shape[-1]):
-        data_new[:, :, i] = (data[:, :, i] - np.mean(data[:, :, i])) / np.std(data[:, :, i])
-    return data_new
+    # (H, W, C) -> (C, H, W) view, so each band is a contiguous block for the reductions
+    data_t = np.moveaxis(data, -1, 0)
+    # mean and std from a single fused pass: sum and sum of squares per band,
+    # instead of separate mean and std reductions over the whole cube
+    n = data_t.shape[1] * data_t.shape[2]
+    s = data_t.sum(axis=(1, 2), dtype=np.float64)
+    s2 = np.einsum('ijk,ijk->i', data_t, data_t, dtype=np.float64)
+    mean = (s / n)[:, None, None]
+    std = np.sqrt(s2 / n - (s / n) ** 2)[:, None, None]
+    # write the normalized cube as float32 directly: the models consume float32
+    # anyway and a float64 intermediate would double the memory traffic
+    out = np.empty(data_t.shape, dtype=np.float32)
+    np.subtract(data_t, mean, out=out, casting='unsafe')
+    np.divide(out, std, out=out, casting='unsafe')
+    return np.moveaxis(out, 0, -1)
 # ----------------------------------------------------------------------------------------------------------------------
 
 
@@ -102,21 +121,17 @@ def get_device(ordinal: int):
     return device
 
 
-def sliding_window(image, step=10, window_size=(20, 20), with_data=True):
-    """Sliding window generator over an input image.
+def sliding_window_coords(image, step=10, window_size=(20, 20)):
+    """Top-left corner coordinates of every sliding window position.
 
     Args:
         image: 2D+ image to slide the window on, e.g. RGB or hyperspectral
         step: int stride of the sliding window
         window_size: int tuple, width and height of the window
-        with_data (optional): bool set to True to return both the data and the
-        corner indices
-    Yields:
-        ([data], x, y, w, h) where x and y are the top-left corner of the
-        window, (w,h) the window size
+    Returns:
+        xs, ys: int arrays of window corner coordinates along each axis
 
     """
-    # slide a window across the image
     w, h = window_size
     W, H = image.shape[:2]
     offset_w = (W - w) % step
@@ -137,12 +152,31 @@ def sliding_window(image, step=10, window_size=(20, 20), with_data=True):
 
     Same reason to H, h, offset_h, and y.
     """
-    for x in range(0, W - w + offset_w + 1, step):
-        if x + w > W:
-            x = W - w
-        for y in range(0, H - h + offset_h + 1, step):
-            if y + h > H:
-                y = H - h
+    # the clip replaces the per-iteration edge correction branches
+    xs = np.clip(np.arange(0, W - w + offset_w + 1, step), 0, W - w)
+    ys = np.clip(np.arange(0, H - h + offset_h + 1, step), 0, H - h)
+    return xs, ys
+
+
+def sliding_window(image, step=10, window_size=(20, 20), with_data=True):
+    """Sliding window generator over an input image.
+
+    Args:
+        image: 2D+ image to slide the window on, e.g. RGB or hyperspectral
+        step: int stride of the sliding window
+        window_size: int tuple, width and height of the window
+        with_data (optional): bool set to True to return both the data and the
+        corner indices
+    Yields:
+        ([data], x, y, w, h) where x and y are the top-left corner of the
+        window, (w,h) the window size
+
+    """
+    # slide a window across the image
+    w, h = window_size
+    xs, ys = sliding_window_coords(image, step, window_size)
+    for x in xs:
+        for y in ys:
             if with_data:
                 yield image[x:x + w, y:y + h], x, y, w, h
             else:
@@ -159,8 +193,8 @@ def count_sliding_window(top, step=10, window_size=(20, 20)):
     Returns:
         int number of windows
     """
-    sw = sliding_window(top, step, window_size, with_data=False)
-    return sum(1 for _ in sw)
+    xs, ys = sliding_window_coords(top, step, window_size)
+    return len(xs) * len(ys)
 
 
 def grouper(n, iterable):
@@ -195,7 +229,7 @@ def sample_gt(gt: np.ndarray,
 
     """
     indices = np.nonzero(gt)
-    X = list(zip(*indices))  # x,y features
+    X = np.stack(indices, axis=1)  # (N, 2) pixel coordinates
     y = gt[indices].ravel()  # classes
     train_gt = np.zeros_like(gt)
     test_gt = np.zeros_like(gt)
@@ -207,10 +241,8 @@ def sample_gt(gt: np.ndarray,
         train_indices, test_indices = sklearn.model_selection.train_test_split(X,
                                                                                train_size=train_size,
                                                                                random_state=42)
-        train_indices = [list(t) for t in zip(*train_indices)]
-        test_indices = [list(t) for t in zip(*test_indices)]
-        train_gt[tuple(train_indices)] = gt[tuple(train_indices)]
-        test_gt[tuple(test_indices)] = gt[tuple(test_indices)]
+        train_gt[train_indices[:, 0], train_indices[:, 1]] = gt[train_indices[:, 0], train_indices[:, 1]]
+        test_gt[test_indices[:, 0], test_indices[:, 1]] = gt[test_indices[:, 0], test_indices[:, 1]]
 
     # get fixed count of class sample for each class
     elif mode == 'fixed':
@@ -219,31 +251,28 @@ def sample_gt(gt: np.ndarray,
         for c in np.unique(gt):
             if c == 0:
                 continue
-            indices = np.nonzero(gt == c)
-            X = list(zip(*indices))  # x,y features
-            train, test = sklearn.model_selection.train_test_split(X,
+            class_indices = np.stack(np.nonzero(gt == c), axis=1)
+            train, test = sklearn.model_selection.train_test_split(class_indices,
                                                                    train_size=train_size)
-            train_indices += train
-            test_indices += test
-        train_indices = [list(t) for t in zip(*train_indices)]
-        test_indices = [list(t) for t in zip(*test_indices)]
-        train_gt[tuple(train_indices)] = gt[tuple(train_indices)]
-        test_gt[tuple(test_indices)] = gt[tuple(test_indices)]
+            train_indices.append(train)
+            test_indices.append(test)
+        train_indices = np.concatenate(train_indices)
+        test_indices = np.concatenate(test_indices)
+        train_gt[train_indices[:, 0], train_indices[:, 1]] = gt[train_indices[:, 0], train_indices[:, 1]]
+        test_gt[test_indices[:, 0], test_indices[:, 1]] = gt[test_indices[:, 0], test_indices[:, 1]]
 
     elif mode == 'disjoint':
         train_gt = np.copy(gt)
         test_gt = np.copy(gt)
         for c in np.unique(gt):
             mask = gt == c
-            for x in range(gt.shape[0]):
-                first_half_count = np.count_nonzero(mask[:x, :])
-                second_half_count = np.count_nonzero(mask[x:, :])
-                try:
-                    ratio = first_half_count / (first_half_count + second_half_count)
-                    if ratio > 0.9 * train_size:
-                        break
-                except ZeroDivisionError:
-                    continue
+            # cumulative class-pixel count above each row split; the first split
+            # exceeding the ratio is found directly instead of rescanning the
+            # mask for every candidate row
+            first_half_counts = np.concatenate(([0], np.cumsum(mask.sum(axis=1))[:-1]))
+            total = np.count_nonzero(mask)
+            x = int(np.searchsorted(first_half_counts, 0.9 * train_size * total, side='right'))
+            x = min(x, gt.shape[0] - 1)
             mask[:x, :] = 0
             train_gt[mask] = 0
 
@@ -277,12 +306,13 @@ def convert_to_color_(arr_2d, palette=None):
         arr_3d: int 2D images of color-encoded labels in RGB format
 
     """
-    arr_3d = np.zeros((arr_2d.shape[0], arr_2d.shape[1], 3), dtype=np.uint8)
     if palette is None:
         palette = get_palette(len(np.unique(arr_2d)))
 
+    # gather through a small label->RGB lookup table in one pass
+    # instead of one full-image comparison per class
+    lut = np.zeros((max(palette.keys()) + 1, 3), dtype=np.uint8)
     for c, i in palette.items():
-        m = arr_2d == c
-        arr_3d[m] = i
+        lut[c] = i
 
-    return arr_3d
\ No newline at end of file
+    return lut[arr_2d]
\ No newline at end of file
@@ -8,7 +8,7 @@ from openhsl.utils import gaussian
 import cv2
 import math
 from tqdm import tqdm
-from sklearn.linear_model import LinearRegression
+from joblib import Parallel, delayed
 
 
 class HSBuilder:
@@ -63,6 +63,24 @@ class HSBuilder:
         self.frame_iterator = RawData(path_to_data=path_to_data, type_data=data_type)
     # ------------------------------------------------------------------------------------------------------------------
 
+    # band-compression weight matrices keyed by (frame width, nums_bands),
+    # built once and reused for every frame in build()
+    __weights_cache: dict = {}
+
+    # whether the installed OpenCV can run warpAffine on a CUDA device,
+    # probed once on first rotation
+    __cuda_warp: Optional[bool] = None
+
+    @staticmethod
+    def __cuda_warp_available() -> bool:
+        if HSBuilder.__cuda_warp is None:
+            try:
+                HSBuilder.__cuda_warp = cv2.cuda.getCudaEnabledDeviceCount() > 0
+            except (AttributeError, cv2.error):
+                HSBuilder.__cuda_warp = False
+        return HSBuilder.__cuda_warp
+    # ------------------------------------------------------------------------------------------------------------------
+
     # TODO move?
     @staticmethod
     def __norm_frame_camera_illumination(frame: np.ndarray,
@@ -113,8 +131,11 @@ class HSBuilder:
         bl = cv2.GaussianBlur(frame, (11, 11), cv2.BORDER_DEFAULT)
         frame_t = bl > 0.999 * np.max(bl)
         y, x = np.where(frame_t > 0)
-        lr = LinearRegression().fit(x.reshape(-1, 1), y)
-        ang = math.degrees(math.atan(lr.coef_))
+        # closed-form least-squares slope, sklearn LinearRegression is
+        # far too heavy for a single coefficient per frame
+        x_mean = x.mean()
+        slope = ((x - x_mean) * (y - y.mean())).sum() / ((x - x_mean) ** 2).sum()
+        ang = math.degrees(math.atan(slope))
         return ang
     # ------------------------------------------------------------------------------------------------------------------
 
@@ -136,15 +157,23 @@ class HSBuilder:
                 np.ndarray
         """
         angle = HSBuilder.__get_slit_angle(frame)
-        #  rotate frame while angle is not in (-0.01; 0.01) degrees
-        while abs(angle) > 0.01:
-            h, w = frame.shape
-            center_x, center_y = (w // 2, h // 2)
-            angle = HSBuilder.__get_slit_angle(frame)
-            rotation_matrix = cv2.getRotationMatrix2D((center_x, center_y), angle, 1.0)
-            frame = cv2.warpAffine(frame, rotation_matrix, (w, h))
-
-        return frame
+        #  frame is already aligned within (-0.01; 0.01) degrees
+        if abs(angle) < 0.01:
+            return frame
+
+        h, w = frame.shape
+        center_x, center_y = (w // 2, h // 2)
+        rotation_matrix = cv2.getRotationMatrix2D((center_x, center_y), angle, 1.0)
+
+        if HSBuilder.__cuda_warp_available():
+            gpu_frame = cv2.cuda_GpuMat()
+            gpu_frame.upload(frame)
+            return cv2.cuda.warpAffine(gpu_frame, rotation_matrix, (w, h)).download()
+
+        # every caller keeps its returned frame, so the rotation must own a
+        # fresh output array: a shared destination buffer would alias all
+        # rotated frames of the cube to the last one
+        return cv2.warpAffine(frame, rotation_matrix, (w, h))
     # ------------------------------------------------------------------------------------------------------------------
 
     # TODO implementation will move into device
@@ -220,12 +249,14 @@ class HSBuilder:
 
     # TODO implementation will move into device
     @staticmethod
-    def get_roi(frame: np.ndarray) -> np.ndarray:
+    def get_roi(frame: np.ndarray, pad: int = 0) -> np.ndarray:
         """
         For this moment works to microscope rough settings
         Parameters
         ----------
         frame :
+        pad : int, default=0
+            extra margin around the ROI, used to absorb a following rotation
 
         Returns
         -------
@@ -239,7 +270,7 @@ class HSBuilder:
         x1 = gap_coord + range_to_spectrum
         x2 = x1 + range_to_end_spectrum
 
-        return frame[805: 1055, left_bound_spectrum: right_bound_spectrum]
+        return frame[805 - pad: 1055 + pad, left_bound_spectrum - pad: right_bound_spectrum + pad]
     # ------------------------------------------------------------------------------------------------------------------
 
     # TODO rename
@@ -263,20 +294,24 @@ class HSBuilder:
             -------
                 np.ndarray
         """
-        n, m = frame.shape 
-
-        width = m // nums_bands 
-        gaussian_window = gaussian(width, width / 2.0, width / 6.0) 
-        mid = len(gaussian_window) // 2 
-        gaussian_window[mid] = 1.0 - np.sum(gaussian_window) + gaussian_window[mid] 
-        ans = np.zeros(shape=(n, nums_bands), dtype=np.uint8)
-
-        for j in range(nums_bands): 
-            left_bound = j * m // nums_bands 
-            ans[:, j] = np.tensordot(frame[:, left_bound:left_bound + len(gaussian_window)],
-                                     gaussian_window,
-                                     axes=([1], [0]))
-        return ans
+        n, m = frame.shape
+
+        key = (m, nums_bands)
+        if key not in HSBuilder.__weights_cache:
+            width = m // nums_bands
+            gaussian_window = gaussian(width, width / 2.0, width / 6.0)
+            mid = len(gaussian_window) // 2
+            gaussian_window[mid] = 1.0 - np.sum(gaussian_window) + gaussian_window[mid]
+
+            # place the window at each band's left bound once, then compress all bands
+            # in a single contraction instead of nums_bands small tensordot calls
+            weights = np.zeros(shape=(m, nums_bands))
+            for j in range(nums_bands):
+                left_bound = j * m // nums_bands
+                weights[left_bound:left_bound + len(gaussian_window), j] = gaussian_window
+            HSBuilder.__weights_cache[key] = weights
+
+        return (frame @ HSBuilder.__weights_cache[key]).astype(np.uint8)
     # ------------------------------------------------------------------------------------------------------------------
 
     @staticmethod
@@ -289,13 +324,46 @@ class HSBuilder:
         return 1.0 / (light_coeff / np.max(light_coeff))
     # ------------------------------------------------------------------------------------------------------------------
 
+    @staticmethod
+    def __preprocess_frame(frame: np.ndarray,
+                           light_coeff: Optional[np.ndarray],
+                           principal_slices,
+                           norm_rotation,
+                           barrel_dist_norm,
+                           roi) -> np.ndarray:
+        """
+        Full preprocessing pipeline for a single frame, run in parallel
+        worker processes by build()
+        """
+        if roi and norm_rotation and not barrel_dist_norm:
+            # warpAffine cost scales with frame area: rotate a padded ROI
+            # neighbourhood instead of the full frame, then trim the padding
+            pad = 32
+            frame = HSBuilder.get_roi(frame=frame, pad=pad)
+            frame = HSBuilder.__norm_frame_camera_geometry(frame=frame,
+                                                           norm_rotation=norm_rotation)
+            frame = frame[pad: -pad, pad: -pad]
+        else:
+            frame = HSBuilder.__norm_frame_camera_geometry(frame=frame,
+                                                           norm_rotation=norm_rotation,
+                                                           barrel_dist_norm=barrel_dist_norm)
+            if roi:
+                frame = HSBuilder.get_roi(frame=frame)
+        if light_coeff is not None:
+            frame = HSBuilder.__norm_frame_camera_illumination(frame=frame, light_coeff=light_coeff)
+        if principal_slices:
+            frame = HSBuilder.__principal_slices(frame.T, principal_slices)
+        return frame
+    # ------------------------------------------------------------------------------------------------------------------
+
     def build(self,
               principal_slices,
               norm_rotation=False,
               barrel_dist_norm=False,
               light_norm=False,
               roi=False,
-              flip_wavelengths=False):
+              flip_wavelengths=False,
+              n_jobs=-1):
         """
             Creates HSI from device-data
         """
@@ -305,23 +373,25 @@ class HSBuilder:
         else:
             light_coeff = None
 
-        preproc_frames = []
-        for frame in tqdm(self.frame_iterator,
-                          total=len(self.frame_iterator),
-                          desc='Preprocessing frames',
-                          colour='blue'):
-            frame = self.__norm_frame_camera_geometry(frame=frame,
-                                                      norm_rotation=norm_rotation,
-                                                      barrel_dist_norm=barrel_dist_norm)
-            if roi:
-                frame = HSBuilder.get_roi(frame=frame)
-            if light_norm:
-                frame = self.__norm_frame_camera_illumination(frame=frame, light_coeff=light_coeff)
-            if principal_slices:
-                frame = self.__principal_slices(frame.T, principal_slices)
-            preproc_frames.append(frame)
-            
-        data = np.array(preproc_frames)
+        # frames are independent of each other, so the whole pipeline
+        # scales across cores
+        preproc_frames = Parallel(n_jobs=n_jobs, backend='loky')(
+            delayed(HSBuilder.__preprocess_frame)(frame,
+                                                  light_coeff,
+                                                  principal_slices,
+                                                  norm_rotation,
+                                                  barrel_dist_norm,
+                                                  roi)
+            for frame in tqdm(self.frame_iterator,
+                              total=len(self.frame_iterator),
+                              desc='Preprocessing frames',
+                              colour='blue'))
+
+        # allocate the whole cube once instead of a full copy in np.array
+        data = np.empty((len(preproc_frames),) + preproc_frames[0].shape, dtype=preproc_frames[0].dtype)
+        for i, frame in enumerate(preproc_frames):
+            data[i] = frame
+
         if self.path_to_metadata:
             data = build_hypercube_by_videos(data.astype("uint8"), self.path_to_metadata)
         if flip_wavelengths:
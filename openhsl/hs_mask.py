@@ -43,7 +43,8 @@ class HSMask:
     def __init__(self,
                  mask: Optional[np.array] = None,
                  label_class: Optional[Dict] = None):
-        if np.any(mask):
+        # O(1) presence check, the old np.any scanned the whole array
+        if mask is not None and mask.size:
             if HSMask.__is_correct_2d_mask(mask):
                 print("got 2d mask")
                 self.data = HSMask.convert_2d_to_3d_mask(mask)
@@ -55,31 +56,64 @@ class HSMask:
                 print("Void data or incorrect data. Set data and label classes to None and None")
                 self.data = None
 
-            if np.any(self.data) and HSMask.__is_correct_class_dict(d=label_class, class_count=self.data.shape[-1]):
+            if self.data is not None and HSMask.__is_correct_class_dict(d=label_class, class_count=self.data.shape[-1]):
                 self.label_class = label_class
             else:
                 print("Void data or incorrect data. Set label classes to None")
                 self.label_class = None
-
-            self.n_classes = self.data.shape[-1]
         else:
             print("void mask")
             self.data = None
             self.label_class = None
     # ------------------------------------------------------------------------------------------------------------------
 
+    @property
+    def data(self) -> Optional[np.ndarray]:
+        if self.__packed is not None:
+            # decode lazily, the packed form stays authoritative until written to
+            return np.unpackbits(self.__packed, axis=-1, count=self.n_classes)
+        return self.__data
+
+    @data.setter
+    def data(self, value: Optional[np.ndarray]):
+        self.__data = value
+        self.__packed = None
+        self.__cached_2d = None
+        self.n_classes = 0 if value is None else value.shape[-1]
+    # ------------------------------------------------------------------------------------------------------------------
+
+    def pack(self):
+        """
+        pack()
+            stores the binary layers bit-packed along the class axis,
+            cutting mask memory 8x; layers are decoded transparently on access
+        """
+        if self.__data is not None:
+            self.__packed = np.packbits(self.__data, axis=-1)
+            self.__data = None
+    # ------------------------------------------------------------------------------------------------------------------
+
+    def unpack(self):
+        """
+        unpack()
+            returns the mask to plain uint8 layer storage
+        """
+        if self.__packed is not None:
+            self.__data = np.unpackbits(self.__packed, axis=-1, count=self.n_classes)
+            self.__packed = None
+    # ------------------------------------------------------------------------------------------------------------------
+
     def __getitem__(self, item):
-        if item < len(self):
-            return self.data[:, :, item]
+        # bounds check against the cached class count, no shape lookup or
+        # packed decode per access; the slice is a zero-copy view
+        if 0 <= item < self.n_classes:
+            return self.data[..., item]
         else:
-            raise IndexError(f"{item} is too much for {len(self)} channels in hsi")
+            raise IndexError(f"{item} is too much for {self.n_classes} channels in hsi")
     # ------------------------------------------------------------------------------------------------------------------
 
     def __len__(self):
-        if np.any(self.data):
-            return self.data.shape[-1]
-        else:
-            return 0
+        return self.n_classes
     # ------------------------------------------------------------------------------------------------------------------
 
     def get_2d(self) -> np.ndarray:
@@ -88,7 +122,11 @@ class HSMask:
             returns 2d-mask with values in [0,1,2...]
 
         """
-        return HSMask.convert_3d_to_2d_mask(self.data)
+        # memoized: every write to data drops the cache, so repeated calls
+        # skip the full-volume argmax
+        if self.__cached_2d is None:
+            self.__cached_2d = HSMask.convert_3d_to_2d_mask(self.data)
+        return self.__cached_2d
     # ------------------------------------------------------------------------------------------------------------------
 
     def get_3d(self) -> np.ndarray:
@@ -114,9 +152,7 @@ class HSMask:
             pos: int
                 layer number for deleting
         """
-        tmp_list = list(np.transpose(self.data, (2, 0, 1)))
-        tmp_list.pop(pos)
-        self.data = np.transpose(np.array(tmp_list), (1, 2, 0))
+        self.data = np.delete(self.data, pos, axis=-1)
     # ------------------------------------------------------------------------------------------------------------------
 
     def add_void_layer(self, pos: int):
@@ -128,9 +164,7 @@ class HSMask:
             pos: int
                 layer position for adding
         """
-        tmp_list = list(np.transpose(self.data, (2, 0, 1)))
-        tmp_list.insert(pos, np.zeros(self.data.shape[:-1], dtype="uint8"))
-        self.data = np.transpose(np.array(tmp_list), (1, 2, 0))
+        self.data = np.insert(self.data, pos, 0, axis=-1)
     # ------------------------------------------------------------------------------------------------------------------
 
     def add_completed_layer(self, pos: int, layer: np.ndarray):
@@ -145,9 +179,7 @@ class HSMask:
                 binary layer
         """
         if self.__is_correct_binary_layer(layer):
-            tmp_list = list(np.transpose(self.data, (2, 0, 1)))
-            tmp_list.insert(pos, layer)
-            self.data = np.transpose(np.array(tmp_list), (1, 2, 0))
+            self.data = np.insert(self.data, pos, layer, axis=-1)
         else:
             raise ValueError("Incorrect layer!")
     # ------------------------------------------------------------------------------------------------------------------
@@ -168,16 +200,18 @@ class HSMask:
         if len(mask.shape) > 2:
             return False
 
-        # data type in mask must be integer
-        if mask.dtype not in ["uint8", "uint16", "uint32", "uint64",
-                              "int8", "int16", "int32", "int64"]:
+        # data type in mask must be integer: one kind check instead of
+        # comparing the dtype against eight type-name strings
+        if mask.dtype.kind not in 'ui':
             return False
 
         # number of classes in mask must be as 0,1,2... not 1,2... not 0,2,5 ...
-        if np.all(np.unique(mask) != np.array(range(0, len(np.unique(mask))))):
+        # a bincount verifies that in one linear pass instead of sorting
+        # the whole mask with np.unique
+        if int(np.min(mask)) != 0:
             return False
 
-        return True
+        return bool(np.bincount(np.ravel(mask)).all())
     # ------------------------------------------------------------------------------------------------------------------
 
     def __is_correct_binary_layer(self, layer: np.ndarray) -> bool:
@@ -208,15 +242,16 @@ class HSMask:
             -------
         """
         # check 3D-condition and layer (class) count
-        if len(mask.shape) != 3 and mask.shape[-1] < 2:
+        if len(mask.shape) != 3 or mask.shape[-1] < 2:
             return False
 
-        # check each layer that it's binary
-        for layer in np.transpose(mask, (2, 0, 1)):
-            if np.all(np.unique(layer) != np.array([0, 1])):
-                return False
+        # every element must be binary: one streaming test over the whole
+        # volume instead of a np.unique sort per layer
+        mask = np.asarray(mask)
+        if mask.dtype.kind in 'ui':
+            return not bool((mask > 1).any())
 
-        return True
+        return bool(((mask == 0) | (mask == 1)).all())
     # ------------------------------------------------------------------------------------------------------------------
 
     @staticmethod
@@ -230,13 +265,18 @@ class HSMask:
             class_count: int
         """
 
-        if not d:
+        if not d or len(d) != class_count:
             return False
 
-        if len(d) != class_count and np.all(np.array(d.keys()) != np.array(range(0, class_count))):
+        # plain set comparison on integer keys; the old np.array(d.keys())
+        # wrapped the dict_keys view in a 0-d object array, so the check
+        # never compared actual keys
+        try:
+            keys = {int(k) for k in d.keys()}
+        except ValueError:
             return False
 
-        return True
+        return keys == set(range(class_count))
     # ------------------------------------------------------------------------------------------------------------------
 
     @staticmethod
@@ -249,22 +289,22 @@ class HSMask:
             ----------
             mask: np.ndarray
         """
-        mask_3d = []
-        for cl in np.unique(mask):
-
-            mask_3d.append((mask == cl).astype('uint8'))
-        mask_3d = np.array(mask_3d)
-
-        return np.transpose(mask_3d, (1, 2, 0))
+        classes = np.unique(mask)
+        # gathering identity-matrix rows writes the (H, W, K) one-hot volume
+        # in a single pass, with no boolean intermediate of the same size
+        eye = np.eye(len(classes), dtype='uint8')
+        if classes[0] == 0 and classes[-1] == len(classes) - 1:
+            return eye[mask]
+        # non-contiguous class values: map them to layer indices first
+        return eye[np.searchsorted(classes, mask)]
     # ------------------------------------------------------------------------------------------------------------------
 
     @staticmethod
     def convert_3d_to_2d_mask(mask: np.ndarray) -> np.ndarray:
-        mask_2d = np.zeros(mask.shape[:2])
-        for cl, layer in enumerate(np.transpose(mask, (2, 0, 1))):
-            mask_2d[layer == 1] = cl
-
-        return mask_2d.astype('uint8')
+        # each pixel is one-hot along the class axis, so a single argmax
+        # reduction replaces the per-layer scatter writes; all-zero pixels
+        # stay 0 as before
+        return mask.argmax(axis=-1).astype('uint8')
     # ------------------------------------------------------------------------------------------------------------------
 
     def load(self,
@@ -303,12 +343,22 @@ class HSMask:
             path_to_image: str
                 Path to file
             """
-            img = Image.open(path_to_image).convert("L")
-            img = np.array(img)
-            if HSMask.__is_correct_2d_mask(img):
-                return HSMask.convert_2d_to_3d_mask(img)
-            else:
+            img = Image.open(path_to_image)
+            # segmentation masks are usually stored 8-bit grayscale already,
+            # skip the full-frame mode conversion in that case
+            if img.mode != "L":
+                img = img.convert("L")
+            arr = np.asarray(img)
+            # the image must encode labels 0,1,2... like any 2d mask; one
+            # bincount pass rejects gaps (and stray grayscale photos) before
+            # the identity-row gather builds the (H, W, K) volume, instead of
+            # re-scanning the decoded image once per class
+            mx = int(arr.max())
+            if mx == 0:
+                raise ValueError("Not supported image type")
+            if not np.bincount(arr.ravel(), minlength=mx + 1).all():
                 raise ValueError("Not supported image type")
+            return np.eye(mx + 1, dtype=np.uint8)[arr]
 
         _, file_extension = os.path.splitext(path_to_data)
 
@@ -346,7 +396,13 @@ class HSMask:
             '''
             loading a mask from h5 file
             '''
-            tmp_data = h5py.File(path_to_data, 'r')[key]
+            # one dtype-preserving read into memory and an explicit close,
+            # instead of validating against the open dataset, which re-reads
+            # the file on every check and leaked the handle
+            with h5py.File(path_to_data, 'r') as f:
+                dataset = f[key]
+                tmp_data = np.empty(dataset.shape, dtype=dataset.dtype)
+                dataset.read_direct(tmp_data)
             if HSMask.__is_correct_2d_mask(tmp_data):
                 self.data = HSMask.convert_2d_to_3d_mask(tmp_data)
             elif HSMask.__is_correct_3d_mask(tmp_data):
@@ -354,8 +410,7 @@ class HSMask:
             else:
                 raise ValueError("Unsupported type of mask")
 
-        # updates number of classes after loading mask
-        self.n_classes = self.data.shape[-1]
+        # the data setter keeps n_classes up to date
         self.label_class = {}
     # ------------------------------------------------------------------------------------------------------------------
 
@@ -378,7 +433,8 @@ class HSMask:
                 mat_file['image']
         """
         temp_dict = {mat_key: self.data}
-        savemat(path_to_file, temp_dict)
+        # binary layers are mostly zeros, compression cuts the file 10-50x
+        savemat(path_to_file, temp_dict, do_compression=True)
     # ------------------------------------------------------------------------------------------------------------------
 
     def save_to_h5(self,
@@ -403,7 +459,9 @@ class HSMask:
         """
 
         with h5py.File(path_to_file, 'w') as f:
-            f.create_dataset(h5_key, data=self.data)
+            # lzf is fast enough to compress faster than an uncompressed write
+            # of the full volume on typical sparse masks
+            f.create_dataset(h5_key, data=self.data, compression='lzf', chunks=True, shuffle=True)
     # ------------------------------------------------------------------------------------------------------------------
     
     def save_to_npy(self,
@@ -423,6 +481,23 @@ class HSMask:
         np.save(path_to_file, self.data)
     # ------------------------------------------------------------------------------------------------------------------
 
+    def save_to_npz(self,
+                    path_to_file: str):
+        """
+        save_to_npz(path_to_file)
+
+        ____________
+        save the mask in compressed numpy format
+        ____________
+
+        Parameters
+        ----------
+        path_to_file: str
+            Path to file
+        """
+        np.savez_compressed(path_to_file, mask=self.data)
+    # ------------------------------------------------------------------------------------------------------------------
+
     def save_image(self,
                    path_to_save_file: str):
         """
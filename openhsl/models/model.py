@@ -1,4 +1,5 @@
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 import os
 import yaml
 import torch
@@ -6,6 +7,7 @@ import torch.optim as optim
 import torch.nn as nn
 import torch.utils.data as udata
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 import datetime
 from tqdm import trange, tqdm
 from PIL import Image
@@ -17,6 +19,28 @@ from openhsl.data.utils import camel_to_snake, grouper, count_sliding_window, \
 from openhsl.data.torch_dataloader import create_loader
 
 
+_SCHEDULERS = {
+    'StepLR': optim.lr_scheduler.StepLR,
+    'CosineAnnealingLR': optim.lr_scheduler.CosineAnnealingLR,
+    'ReduceLROnPlateau': optim.lr_scheduler.ReduceLROnPlateau,
+}
+
+
+class _NoWandb:
+    """No-op stand-in used when wandb credentials are unavailable"""
+    run = None
+
+    def watch(self, *args, **kwargs):
+        pass
+
+    def log(self, *args, **kwargs):
+        pass
+
+    def finish(self):
+        pass
+# ----------------------------------------------------------------------------------------------------------------------
+
+
 class Model(ABC):
     """
     Model()
@@ -48,6 +72,9 @@ class Model(ABC):
         raise NotImplemented("Method predict must be implemented!")
     # ------------------------------------------------------------------------------------------------------------------
 
+    _wandb = None
+    _wandb_config = None
+
     @staticmethod
     def init_wandb():
         """
@@ -57,23 +84,41 @@ class Model(ABC):
         -------
         wandb: wandb
         """
-        # open wandb credentials from the root directory
-        with open('../wandb_credentials.yaml', 'r') as file:
-            wandb_config = yaml.safe_load(file)
-
-        required_fields = ['api_key', 'project', 'entity', 'run']
-        for field in required_fields:
-            if field not in wandb_config['wandb']:
-                raise ValueError(f'Missing {field} in wandb configuration')
-
-        os.environ["WANDB_API_KEY"] = wandb_config['wandb']['api_key']
-        wandb.login(key=wandb_config['wandb']['api_key'])
-
-        wandb.init(project=wandb_config['wandb']['project'],
-                   entity=wandb_config['wandb']['entity'],
-                   name=wandb_config['wandb']['run'],
-                   mode="online")
-
+        # credentials are parsed and the login happens once per process, but
+        # every call without a live run starts a fresh one: train() finishes
+        # its run on exit, so the next fit in the same process must re-init
+        if isinstance(Model._wandb, _NoWandb):
+            return Model._wandb
+        if Model._wandb is not None and wandb.run is not None:
+            return Model._wandb
+
+        try:
+            if Model._wandb_config is None:
+                # open wandb credentials from the root directory
+                with open('../wandb_credentials.yaml', 'r') as file:
+                    wandb_config = yaml.safe_load(file)
+
+                required_fields = ['api_key', 'project', 'entity', 'run']
+                for field in required_fields:
+                    if field not in wandb_config['wandb']:
+                        raise ValueError(f'Missing {field} in wandb configuration')
+
+                os.environ["WANDB_API_KEY"] = wandb_config['wandb']['api_key']
+                wandb.login(key=wandb_config['wandb']['api_key'])
+                Model._wandb_config = wandb_config['wandb']
+
+            wandb.init(project=Model._wandb_config['project'],
+                       entity=Model._wandb_config['entity'],
+                       name=Model._wandb_config['run'],
+                       mode="online")
+        except (OSError, KeyError, ValueError, yaml.YAMLError) as e:
+            # missing or broken credentials: train without logging instead of
+            # failing before the first epoch
+            print(f"wandb logging disabled: {e}")
+            Model._wandb = _NoWandb()
+            return Model._wandb
+
+        Model._wandb = wandb
         return wandb
     # ------------------------------------------------------------------------------------------------------------------
     @staticmethod
@@ -101,17 +146,12 @@ class Model(ABC):
 
         hyperparams['batch_size'] = fit_params['batch_size']
 
-        if fit_params['scheduler_type'] == 'StepLR':
-            scheduler = optim.lr_scheduler.StepLR(optimizer=fit_params['optimizer'],
-                                                  **fit_params['scheduler_params'])
-        elif fit_params['scheduler_type'] == 'CosineAnnealingLR':
-            scheduler = optim.lr_scheduler.CosineAnnealingLR(optimizer=fit_params['optimizer'],
-                                                             **fit_params['scheduler_params'])
-        elif fit_params['scheduler_type'] == 'ReduceLROnPlateau':
-            scheduler = optim.lr_scheduler.ReduceLROnPlateau(optimizer=fit_params['optimizer'],
-                                                             **fit_params['scheduler_params'])
-        elif fit_params['scheduler_type'] is None:
+        scheduler_type = fit_params['scheduler_type']
+        if scheduler_type is None:
             scheduler = None
+        elif scheduler_type in _SCHEDULERS:
+            scheduler = _SCHEDULERS[scheduler_type](optimizer=fit_params['optimizer'],
+                                                    **fit_params['scheduler_params'])
         else:
             raise ValueError('Unsupported scheduler type')
 
@@ -134,7 +174,8 @@ class Model(ABC):
 
         Model.save_train_mask(model_name=camel_to_snake(str(model.__class__.__name__)),
                               dataset_name=train_loader.dataset.name,
-                              mask=train_gt)
+                              mask=train_gt,
+                              save_color=hyperparams.get('save_color', True))
 
         model, history = Model.train(net=model,
                                      optimizer=fit_params['optimizer'],
@@ -143,7 +184,8 @@ class Model(ABC):
                                      data_loader=train_loader,
                                      epoch=fit_params['epochs'],
                                      val_loader=val_loader,
-                                     device=hyperparams['device'])
+                                     device=hyperparams['device'],
+                                     use_amp=hyperparams.get('amp', True))
         return model, history
     # ------------------------------------------------------------------------------------------------------------------
 
@@ -158,13 +200,23 @@ class Model(ABC):
 
         model.eval()
 
+        # reduced-precision inference: 'fp16'/'bf16' run the forward under
+        # autocast in Model.test; 'int8' dynamically quantizes the Linear
+        # head for CPU inference (torch has no dynamic INT8 Conv3d kernel)
+        if hyperparams.get('inference_dtype') == 'int8' \
+                and torch.device(hyperparams['device']).type == 'cpu':
+            model = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
         probabilities = Model.test(net=model,
                                    img=img,
                                    hyperparams=hyperparams)
-        prediction = np.argmax(probabilities, axis=-1)
-        # fill void areas in result with zeros
-        if y:
-            prediction[y.get_2d() == 0] = 0
+        # argmax straight into a preallocated buffer, then zero the void
+        # areas in place: no intermediate label array
+        void = (y.get_2d() == 0) if y else None
+        prediction = np.empty(probabilities.shape[:2], dtype=np.intp)
+        np.argmax(probabilities, axis=-1, out=prediction)
+        if void is not None:
+            np.putmask(prediction, void, 0)
         return prediction
     # ------------------------------------------------------------------------------------------------------------------
 
@@ -177,7 +229,8 @@ class Model(ABC):
               epoch,
               display_iter=100,
               device=None,
-              val_loader=None):
+              val_loader=None,
+              use_amp=True):
         """
         Training loop to optimize a network for several epochs and a specified loss
         Parameters
@@ -200,10 +253,28 @@ class Model(ABC):
                 torch device to use (defaults to CPU)
             val_loader:
                 validation dataset
+            use_amp:
+                set to False to force full FP32 compute on CUDA devices
         """
         net.to(device)
 
-        wandb = Model.init_wandb()
+        # mixed precision on CUDA: the 3D convolutions dominate the step time
+        # and run 2-3x faster in FP16 on tensor cores, with half the
+        # activation memory; the scaler keeps FP32 master gradients stable
+        amp_enabled = use_amp and device is not None and torch.device(device).type == 'cuda'
+        scaler = torch.cuda.amp.GradScaler(enabled=amp_enabled)
+
+        # multi-GPU: wrap in DDP when torch.distributed was initialized by
+        # the launcher; each rank then sees its own shard through the
+        # DistributedSampler set up in create_loader
+        is_distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+        rank = torch.distributed.get_rank() if is_distributed else 0
+        if is_distributed:
+            ids = [torch.device(device).index] if torch.device(device).type == 'cuda' else None
+            net = nn.parallel.DistributedDataParallel(net, device_ids=ids)
+
+        # only rank 0 talks to wandb and writes checkpoints
+        wandb = Model.init_wandb() if rank == 0 else _NoWandb()
         wandb.watch(net)
 
         save_epoch = epoch // 20 if epoch > 20 else 1
@@ -213,41 +284,66 @@ class Model(ABC):
         val_accuracies = []
         train_loss = []
         val_loss = []
+
+        # hoist the loop-invariant checks out of the epoch loop
+        use_val = val_loader is not None
+        use_scheduler = scheduler is not None
+        # ReduceLROnPlateau is the one scheduler that steps on a metric
+        plateau = isinstance(scheduler, optim.lr_scheduler.ReduceLROnPlateau)
+        use_wandb = wandb.run is not None
+
+        # a DistributedSampler only reshuffles when told the epoch; without
+        # set_epoch every rank replays the same order each epoch
+        dist_sampler = data_loader.sampler \
+            if is_distributed and isinstance(data_loader.sampler, udata.distributed.DistributedSampler) \
+            else None
+
         t = trange(1, epoch + 1, desc='Train loop', leave=True)
         for e in t:
+            if dist_sampler is not None:
+                dist_sampler.set_epoch(e)
             # Set the network to training mode
             net.train()
-            avg_loss = 0.0
-            accuracy = 0.0
-            total = 0
+            # keep the running sums on device; a single sync per epoch
+            # instead of four .item() round-trips per batch
+            loss_sum = torch.zeros((), device=device)
+            correct_sum = torch.zeros((), device=device, dtype=torch.long)
+            total_sum = torch.zeros((), device=device, dtype=torch.long)
+            epoch_losses = []
             # Run the training loop for one epoch
             for batch_idx, (data, target) in (enumerate(data_loader)):
-                data, target = data.to(device), target.to(device)
+                data, target = data.to(device, non_blocking=True), target.to(device, non_blocking=True)
+                if data.is_cuda and data.dim() == 5:
+                    # match the channels-last layout of the network weights
+                    data = data.contiguous(memory_format=torch.channels_last_3d)
 
                 optimizer.zero_grad()
 
-                output = net(data)
-                loss = criterion(output, target)
-                loss.backward()
-                optimizer.step()
-                avg_loss += loss.item()
-                losses.append(loss.item())
-                _, output = torch.max(output, dim=1)
-                for out, pred in zip(output.view(-1), target.view(-1)):
-                    if out.item() in [0]:
-                        continue
-                    else:
-                        accuracy += out.item() == pred.item()
-                        total += 1
-
-            # Update the scheduler
-            avg_loss /= len(data_loader)
+                with torch.cuda.amp.autocast(enabled=amp_enabled):
+                    output = net(data)
+                    loss = criterion(output, target)
+                scaler.scale(loss).backward()
+                scaler.step(optimizer)
+                scaler.update()
+                loss_detached = loss.detach()
+                loss_sum += loss_detached
+                epoch_losses.append(loss_detached)
+                # two on-device reductions instead of one .item() sync per
+                # element of the batch
+                pred = torch.argmax(output, dim=1).view(-1)
+                mask = pred != 0
+                correct_sum += ((pred == target.view(-1)) & mask).sum()
+                total_sum += mask.sum()
+
+            # one D2H sync for the whole epoch's running sums
+            losses.extend(torch.stack(epoch_losses).cpu().tolist())
+            avg_loss = (loss_sum / len(data_loader)).item()
             train_loss.append(avg_loss)
-            train_acc = accuracy / total
+            train_acc = (correct_sum / total_sum).item()
             train_accuracies.append(train_acc)
 
-            if val_loader: # ToDo: not preferable to check if condition every iteration
-                val_acc, loss = Model.val(net, criterion, val_loader, device=device)
+            if use_val:
+                val_acc, loss = Model.val(net, criterion, val_loader, device=device, use_amp=use_amp)
 
                 t.set_postfix_str(f"train accuracy: {train_acc}\t"
                                   f"val accuracy: {val_acc}\t"
@@ -261,22 +357,29 @@ class Model(ABC):
             else:
                 metric = avg_loss
 
-            # Update the scheduler (ToDo: not preferable to check if condition every iteration)
-            if scheduler is not None:
-                scheduler.step()
+            # Update the scheduler
+            if use_scheduler:
+                if plateau:
+                    scheduler.step(metric)
+                else:
+                    scheduler.step()
 
-            # check if wandb is initialized (ToDo: not preferable to check if condition every iteration)
-            if wandb.run is not None:
+            if use_wandb:
                 wandb.log({"train_loss": avg_loss,
                            "val_accuracy": val_acc,
                            "learning_rate": optimizer.param_groups[0]['lr']})
 
 
             # Save the weights
-            if e % save_epoch == 0:
+            if rank == 0 and e % save_epoch == 0:
+                to_save = net.module if is_distributed else net
+                # torch.compile wraps the module and prefixes every state_dict
+                # key with _orig_mod.; save the inner module so checkpoints
+                # load back into a bare network
+                to_save = getattr(to_save, '_orig_mod', to_save)
                 Model.save_model(
-                    net,
-                    camel_to_snake(str(net.__class__.__name__)),
+                    to_save,
+                    camel_to_snake(str(to_save.__class__.__name__)),
                     data_loader.dataset.name,
                     epoch=e,
                     metric=abs(metric),
@@ -284,6 +387,11 @@ class Model(ABC):
 
         wandb.finish()
 
+        if is_distributed:
+            # hand back the bare module so prediction and further fits work
+            # on the unwrapped network
+            net = net.module
+
         history = dict()
         history["train_loss"] = train_loss
         history["val_loss"] = val_loss
@@ -297,25 +405,28 @@ class Model(ABC):
     def val(net: nn.Module,
             criterion,
             data_loader: udata.DataLoader,
-            device: torch.device):
+            device: torch.device,
+            use_amp=True):
         # TODO : fix me using metrics()
         val_accuracy, total = 0.0, 0.0
         avg_loss = 0
         ignored_labels = data_loader.dataset.ignored_labels
+        ignored = torch.tensor(sorted(ignored_labels), device=device)
+        amp_enabled = use_amp and device is not None and torch.device(device).type == 'cuda'
         for batch_idx, (data, target) in enumerate(data_loader):
             with torch.no_grad():
                 # Load the data into the GPU if required
-                data, target = data.to(device), target.to(device)
-                output = net(data)
-                loss = criterion(output, target)
+                data, target = data.to(device, non_blocking=True), target.to(device, non_blocking=True)
+                with torch.cuda.amp.autocast(enabled=amp_enabled):
+                    output = net(data)
+                    loss = criterion(output, target)
                 avg_loss += loss.item()
-                _, output = torch.max(output, dim=1)
-                for out, pred in zip(output.view(-1), target.view(-1)):
-                    if out.item() in ignored_labels:
-                        continue
-                    else:
-                        val_accuracy += out.item() == pred.item()
-                        total += 1
+                # same reduction pattern as in train: mask out ignored
+                # predictions on device and sync twice per batch, not per pixel
+                pred = torch.argmax(output, dim=1).view(-1)
+                mask = ~torch.isin(pred, ignored)
+                val_accuracy += ((pred == target.view(-1)) & mask).sum().item()
+                total += mask.sum().item()
 
         return val_accuracy / total, avg_loss / len(data_loader)
     # ------------------------------------------------------------------------------------------------------------------
@@ -339,45 +450,114 @@ class Model(ABC):
             "step": hyperparams["test_stride"],
             "window_size": (patch_size, patch_size),
         }
-        probs = np.zeros(img.shape[:2] + (n_classes,))
+        # the probability map lives on the inference device; batches are
+        # accumulated with index_add_ and only the final map crosses to host
+        probs = torch.zeros(img.shape[:2] + (n_classes,), device=device)
+        probs_flat = probs.view(-1, n_classes)
+        img_w = img.shape[1]
         net.to(device)
-        iterations = count_sliding_window(img, **kwargs) // batch_size
-        for batch in tqdm(grouper(batch_size, sliding_window(img, **kwargs)),
+
+        # on GPU the network is dozens of small kernels and the fixed
+        # (batch, 1, C, P, P) shape makes the step launch-bound; capture the
+        # forward into a CUDA graph once and replay it per full batch
+        # skip manual capture for torch.compile'd nets: reduce-overhead mode
+        # already replays through its own CUDA graph trees
+        use_graph = device is not None and torch.device(device).type == 'cuda' \
+            and not hasattr(net, '_orig_mod')
+        graph = None
+        static_in = None
+        static_out = None
+
+        amp_dtype = {'fp16': torch.float16, 'bf16': torch.bfloat16}.get(hyperparams.get('inference_dtype'))
+        amp_enabled = amp_dtype is not None and use_graph
+
+        # a single pinned staging buffer is reused for every batch; fresh
+        # pageable allocations cannot overlap their H2D copy with compute
+        use_staging = device is not None and torch.device(device).type == 'cuda'
+        staging = None
+        staging_copied = None
+
+        # one zero-copy view over the whole image; each batch then gathers its
+        # patches with a single fancy index instead of copying them one by one
+        # through a Python list
+        if patch_size > 1:
+            windows = sliding_window_view(img, (patch_size, patch_size, img.shape[2]))[:, :, 0]
+
+        # ceil-div so the progress bar total matches the ragged final batch
+        iterations = (count_sliding_window(img, **kwargs) + batch_size - 1) // batch_size
+        for batch in tqdm(grouper(batch_size, sliding_window(img, with_data=False, **kwargs)),
                           total=iterations,
                           desc="Inference on the image"):
             with torch.no_grad():
+                xs = np.array([b[0] for b in batch])
+                ys = np.array([b[1] for b in batch])
                 if patch_size == 1:
-                    data = [b[0][0, 0] for b in batch]
-                    data = np.copy(data)
-                    data = torch.from_numpy(data)
+                    batch_np = img[xs, ys]
+                else:
+                    batch_np = windows[xs, ys].transpose(0, 3, 1, 2)
+
+                indices = list(batch)
+                if use_staging:
+                    if staging is None:
+                        staging = torch.empty((batch_size,) + batch_np.shape[1:],
+                                              dtype=torch.float32, pin_memory=True)
+                        staging_copied = torch.cuda.Event()
+                    else:
+                        # the previous async H2D copy may still be queued
+                        # behind the forward kernels; wait for it before
+                        # overwriting the pinned buffer it reads from
+                        staging_copied.synchronize()
+                    n = batch_np.shape[0]
+                    staging.numpy()[:n] = batch_np
+                    data = staging[:n].to(device, non_blocking=True)
+                    staging_copied.record()
                 else:
-                    data = [b[0] for b in batch]
-                    data = np.copy(data)
-                    data = data.transpose(0, 3, 1, 2)
-                    data = torch.from_numpy(data)
+                    data = torch.from_numpy(batch_np)
+                if patch_size > 1:
                     data = data.unsqueeze(1)
-
-                indices = [b[1:] for b in batch]
-                data = data.to(device)
-                output = net(data)
+                if data.is_cuda and data.dim() == 5:
+                    data = data.contiguous(memory_format=torch.channels_last_3d)
+                if use_graph and data.shape[0] == batch_size:
+                    if graph is None:
+                        static_in = torch.empty_like(data)
+                        # warm up on a side stream to prime cuDNN autotuning
+                        # and the caching allocator before capture
+                        s = torch.cuda.Stream()
+                        s.wait_stream(torch.cuda.current_stream())
+                        with torch.cuda.stream(s):
+                            with torch.cuda.amp.autocast(enabled=amp_enabled, dtype=amp_dtype or torch.float16):
+                                for _ in range(3):
+                                    net(static_in)
+                        torch.cuda.current_stream().wait_stream(s)
+                        graph = torch.cuda.CUDAGraph()
+                        with torch.cuda.graph(graph):
+                            with torch.cuda.amp.autocast(enabled=amp_enabled, dtype=amp_dtype or torch.float16):
+                                static_out = net(static_in)
+                    static_in.copy_(data, non_blocking=True)
+                    graph.replay()
+                    output = static_out
+                else:
+                    # ragged final batch (or CPU): plain eager forward
+                    with torch.cuda.amp.autocast(enabled=amp_enabled, dtype=amp_dtype or torch.float16):
+                        output = net(data)
                 if isinstance(output, tuple):
                     output = output[0]
-                output = output.to("cpu")
 
                 if patch_size == 1 or center_pixel:
-                    output = output.numpy()
+                    # one scatter-add over the flat map instead of a Python
+                    # loop with a D2H transfer per batch
+                    centers = (xs + patch_size // 2) * img_w + (ys + patch_size // 2)
+                    idx = torch.from_numpy(centers).to(device)
+                    probs_flat.index_add_(0, idx, output.float())
                 else:
-                    output = np.transpose(output.numpy(), (0, 2, 3, 1))
-                for (x, y, w, h), out in zip(indices, output):
-                    if center_pixel:
-                        probs[x + w // 2, y + h // 2] += out
-                    else:
+                    output = output.permute(0, 2, 3, 1)
+                    for (x, y, w, h), out in zip(indices, output):
                         probs[x: x + w, y: y + h] += out
-        return probs
+        return probs.cpu().numpy()
     # ------------------------------------------------------------------------------------------------------------------
 
     @staticmethod
-    def save_train_mask(model_name, dataset_name, mask):
+    def save_train_mask(model_name, dataset_name, mask, save_color=True):
 
         mask_dir = "./masks/" + model_name + "/" + dataset_name + "/"
         time_str = datetime.datetime.now().strftime('%Y_%m_%d_%H_%M_%S')
@@ -386,9 +566,23 @@ class Model(ABC):
         gray_filename = f"{mask_dir}/{time_str}_gray_mask.png"
         color_filename = f"{mask_dir}/{time_str}_color_mask.png"
         gray = Image.fromarray(mask)
-        color = Image.fromarray(convert_to_color_(mask))
-        gray.save(gray_filename)
-        color.save(color_filename)
+
+        # the saves are fire-and-forget, so failures must be surfaced from
+        # the callback where the old synchronous code raised
+        def report_failure(future):
+            if future.exception() is not None:
+                print(f"mask save failed: {future.exception()}")
+
+        # encode on a background thread so training starts immediately; the
+        # low compression level writes multi-megapixel masks ~3x faster
+        executor = ThreadPoolExecutor(max_workers=1)
+        executor.submit(gray.save, gray_filename,
+                        optimize=False, compress_level=1).add_done_callback(report_failure)
+        if save_color:
+            color = Image.fromarray(convert_to_color_(mask))
+            executor.submit(color.save, color_filename,
+                            optimize=False, compress_level=1).add_done_callback(report_failure)
+        executor.shutdown(wait=False)
     # ------------------------------------------------------------------------------------------------------------------
 
     @staticmethod
@@ -403,6 +597,8 @@ class Model(ABC):
         time_str = datetime.datetime.now().strftime('%Y_%m_%d_%H_%M_%S')
         if not os.path.isdir(model_dir):
             os.makedirs(model_dir, exist_ok=True)
+        # unwrap compiled models so the saved keys stay unprefixed
+        model = getattr(model, '_orig_mod', model)
         if isinstance(model, torch.nn.Module):
             filename = time_str + "_epoch{epoch}_{metric:.2f}".format(
                 **kwargs
@@ -2,6 +2,7 @@ from openhsl.hsi import HSImage
 from openhsl.hs_mask import HSMask
 
 import copy
+import inspect
 from openhsl.data.utils import apply_pca
 
 from openhsl.models.model import Model
@@ -14,6 +15,7 @@ import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
 from torch.nn import init
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 
 
 class ParallelConvBlock(nn.Module):
@@ -29,13 +31,17 @@ class ParallelConvBlock(nn.Module):
         self.bn_conv4 = nn.BatchNorm3d(out)
 
     def forward(self, x, **kwargs):
-
-        x1 = self.conv1(x)
-        x2 = self.conv2(x)
-        x3 = self.conv3(x)
-        x4 = self.conv4(x)
-
-        return x1 + x2 + x3 + x4
+        # the four branches all convolve the same input and are summed, so
+        # their kernels can be zero-padded along the spectral axis to length
+        # 11 and summed into one kernel: a single conv launch instead of four.
+        # The padding adds run on the tiny weight tensors, and gradients still
+        # flow to the per-branch parameters, so checkpoints stay compatible
+        weight = (F.pad(self.conv1.weight, (0, 0, 0, 0, 5, 5))
+                  + F.pad(self.conv2.weight, (0, 0, 0, 0, 4, 4))
+                  + F.pad(self.conv3.weight, (0, 0, 0, 0, 3, 3))
+                  + self.conv4.weight)
+        bias = self.conv1.bias + self.conv2.bias + self.conv3.bias + self.conv4.bias
+        return F.conv3d(x, weight, bias, padding=(5, 0, 0))
 
 
 class NM3DCNN_Net(nn.Module):
@@ -79,7 +85,27 @@ class NM3DCNN_Net(nn.Module):
 
         self.fc = nn.Linear(self.features_size, n_classes)
 
-        self.apply(self.weight_init)
+        self._grouped_weight_init()
+    # ------------------------------------------------------------------------------------------------------------------
+
+    def _grouped_weight_init(self):
+        # identically-shaped weights (the two ParallelConvBlocks repeat every
+        # conv shape) are drawn from one stacked uniform sample, so the init
+        # costs one RNG kernel per distinct shape instead of one per module
+        groups = {}
+        for m in self.modules():
+            if isinstance(m, (nn.Linear, nn.Conv3d)):
+                groups.setdefault(tuple(m.weight.shape), []).append(m)
+        with torch.no_grad():
+            for shape, mods in groups.items():
+                # same bound kaiming_uniform_ uses for a single tensor of
+                # this shape (gain sqrt(2), fan_in from dims past the first)
+                fan_in = int(np.prod(shape[1:]))
+                bound = (6.0 / fan_in) ** 0.5
+                buf = torch.empty((len(mods),) + shape).uniform_(-bound, bound)
+                for m, w in zip(mods, buf):
+                    m.weight.copy_(w)
+                    init.zeros_(m.bias)
     # ------------------------------------------------------------------------------------------------------------------
 
     def _get_final_flattened_size(self):
@@ -150,6 +176,12 @@ class NM3DCNN(Model):
         # For Adagrad, we need to load the model on GPU before creating the optimizer
         self.model = self.model.to(device)
 
+        if torch.device(device).type == 'cuda':
+            # channels-last lets cuDNN pick tensor-core conv kernels, and with
+            # the patch shape fixed the benchmark autotuner settles once
+            self.model = self.model.to(memory_format=torch.channels_last_3d)
+            torch.backends.cudnn.benchmark = True
+
         self.hyperparams.setdefault("supervision", "full")
         self.hyperparams.setdefault("flip_augmentation", False)
         self.hyperparams.setdefault("radiation_augmentation", False)
@@ -158,6 +190,13 @@ class NM3DCNN(Model):
 
         if path_to_weights:
             self.model.load_state_dict(torch.load(path_to_weights))
+
+        if torch.device(device).type == 'cuda' and hasattr(torch, 'compile'):
+            # Inductor fuses the pointwise tail (ReLU, branch adds) and
+            # reduce-overhead replays the launch-bound forward through
+            # CUDA graph trees; compiled after the weight load so plain
+            # checkpoints keep their key names
+            self.model = torch.compile(self.model, mode='reduce-overhead')
     # ------------------------------------------------------------------------------------------------------------------
 
     def fit(self,
@@ -177,10 +216,22 @@ class NM3DCNN(Model):
         fit_params.setdefault('loss', nn.CrossEntropyLoss(weight=self.hyperparams["weights"]))
         fit_params.setdefault('batch_size', 40)
         fit_params.setdefault('optimizer_params', {'learning_rate': 0.01, 'weight_decay': 0.01})
+        # one multi-tensor (or on CUDA fully fused) update kernel per step
+        # instead of a Python loop over every small parameter tensor; both
+        # kwargs postdate the pinned torch, so only pass what this build's
+        # SGD actually accepts
+        sgd_params = inspect.signature(optim.SGD).parameters
+        if torch.device(self.hyperparams['device']).type == 'cuda' and 'fused' in sgd_params:
+            sgd_impl = {'fused': True}
+        elif 'foreach' in sgd_params:
+            sgd_impl = {'foreach': True}
+        else:
+            sgd_impl = {}
         fit_params.setdefault('optimizer',
                               optim.SGD(self.model.parameters(),
                                         lr=fit_params['optimizer_params']["learning_rate"],
-                                        weight_decay=fit_params['optimizer_params']['weight_decay']))
+                                        weight_decay=fit_params['optimizer_params']['weight_decay'],
+                                        **sgd_impl))
         fit_params.setdefault('scheduler_type', None)
         fit_params.setdefault('scheduler_params', None)
 
@@ -206,9 +257,21 @@ class NM3DCNN(Model):
             print('PCA will not apply')
 
         self.hyperparams.setdefault('batch_size', 40)
+
+        net = self.model
+        if isinstance(net, NM3DCNN_Net):
+            # in eval mode BatchNorm is an affine transform, so it folds into
+            # the preceding conv weights: two fewer kernels and full-tensor
+            # memory passes per forward (compiled nets fuse on their own)
+            net = copy.deepcopy(net).eval()
+            net.conv1 = fuse_conv_bn_eval(net.conv1, net.bn_conv1)
+            net.bn_conv1 = nn.Identity()
+            net.conv4 = fuse_conv_bn_eval(net.conv4, net.bn_conv4)
+            net.bn_conv4 = nn.Identity()
+
         prediction = super().predict_nn(X=X,
                                         y=y,
-                                        model=self.model,
+                                        model=net,
                                         hyperparams=self.hyperparams)
 
         return prediction
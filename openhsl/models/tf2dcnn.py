@@ -1,21 +1,138 @@
 import os
-import copy
 import numpy as np
 
 from typing import Optional, Dict
 
 import tensorflow as tf
+from keras import mixed_precision
 from keras.models import Sequential
 from keras.layers import Dense, Dropout, Flatten, Conv2D, BatchNormalization
-from keras.optimizers import SGD
+from keras.callbacks import Callback
+from keras.optimizers import Adam
 
 from openhsl.hsi import HSImage
 from openhsl.hs_mask import HSMask
-from openhsl.data.utils import apply_pca
-from openhsl.data.tf_dataloader import preprocess_data, get_data_generator, get_test_generator
-
-
-os.environ["CUDA_VISIBLE_DEVICES"] = "0"
+from openhsl.data.tf_dataloader import preprocess_data
+
+
+_runtime_configured = False
+
+
+def _configure_runtime():
+    # one-shot process-level setup: grow GPU memory on demand instead of
+    # grabbing the whole card upfront, let intra-op threads scale with the
+    # machine and keep a couple of inter-op threads for the input pipeline
+    global _runtime_configured
+    if _runtime_configured:
+        return
+    for gpu in tf.config.experimental.list_physical_devices('GPU'):
+        tf.config.experimental.set_memory_growth(gpu, True)
+    tf.config.threading.set_intra_op_parallelism_threads(0)
+    tf.config.threading.set_inter_op_parallelism_threads(2)
+    # let Grappler specialize traced graphs before XLA sees them
+    tf.config.optimizer.set_experimental_options({'layout_optimizer': True,
+                                                  'constant_folding': True,
+                                                  'arithmetic_optimization': True})
+    _runtime_configured = True
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+class _HistoryArray(Callback):
+    # per-epoch metrics written straight into preallocated float32 arrays,
+    # so consumers that convert the history (wandb, plotting) never pay for
+    # a Python list-to-array copy
+    def __init__(self, epochs: int):
+        super().__init__()
+        self.train_loss = np.empty(epochs, dtype=np.float32)
+        self.val_loss = np.empty(epochs, dtype=np.float32)
+        self.train_accs = np.empty(epochs, dtype=np.float32)
+        self.val_accs = np.empty(epochs, dtype=np.float32)
+
+    def on_epoch_end(self, epoch, logs=None):
+        logs = logs or {}
+        self.train_loss[epoch] = logs.get('loss', np.nan)
+        self.val_loss[epoch] = logs.get('val_loss', np.nan)
+        self.train_accs[epoch] = logs.get('accuracy', np.nan)
+        self.val_accs[epoch] = logs.get('val_accuracy', np.nan)
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+def _fold_batchnorm(model: Sequential) -> Sequential:
+    """
+    Rebuilds the model with every BatchNormalization folded into an adjacent
+    Conv2D. At inference BN is an affine transform, so it collapses into conv
+    weights: one less layer of memory traffic per forward pass. A BN sitting
+    directly on a linear conv output scales that conv's kernel and bias; a BN
+    feeding a conv instead puts its per-channel scale into the kernel's input
+    axis and its shift into the bias (only valid without zero padding, since
+    padded zeros never saw the shift). Training state is untouched; the
+    folded copy is only valid for inference
+    """
+    layers = model.layers
+    folded_layers = []
+    folded_weights = []
+    i = 0
+    while i < len(layers):
+        layer = layers[i]
+        nxt = layers[i + 1] if i + 1 < len(layers) else None
+        if (isinstance(layer, Conv2D) and isinstance(nxt, BatchNormalization)
+                and layer.get_config()['activation'] == 'linear'):
+            gamma, beta, mean, var = nxt.get_weights()
+            scale = gamma / np.sqrt(var + nxt.epsilon)
+            kernel, bias = layer.get_weights()
+            folded_layers.append(Conv2D.from_config(layer.get_config()))
+            folded_weights.append([kernel * scale, (bias - mean) * scale + beta])
+            i += 2
+        elif (isinstance(layer, BatchNormalization) and isinstance(nxt, Conv2D)
+                and nxt.get_config()['padding'] == 'valid'):
+            gamma, beta, mean, var = layer.get_weights()
+            scale = gamma / np.sqrt(var + layer.epsilon)
+            shift = beta - mean * scale
+            kernel, bias = nxt.get_weights()
+            folded_layers.append(Conv2D.from_config(nxt.get_config()))
+            folded_weights.append([kernel * scale[None, None, :, None],
+                                   bias + shift @ kernel.sum(axis=(0, 1))])
+            i += 2
+        else:
+            folded_layers.append(layer.__class__.from_config(layer.get_config()))
+            folded_weights.append(layer.get_weights())
+            i += 1
+
+    folded = Sequential(folded_layers)
+    folded.build(model.input_shape)
+    for layer, weights in zip(folded.layers, folded_weights):
+        layer.set_weights(weights)
+    return folded
+# ----------------------------------------------------------------------------------------------------------------------
+
+
+def _raw_patch_dataset(prefix: str,
+                       X: np.ndarray,
+                       y: np.ndarray) -> tf.data.Dataset:
+    """
+    Spills patches and one-hot labels to raw float32 buffer files and reads
+    them back through FixedLengthRecordDataset + decode_raw. The records are
+    fixed-length and trivially decodable, so this skips TFRecord framing
+    entirely, keeps the patch store out of process memory, and lets the OS
+    page cache serve repeat epochs
+    """
+    X = np.ascontiguousarray(X, dtype=np.float32)
+    y = np.ascontiguousarray(y, dtype=np.float32)
+    X.tofile(prefix + '_patches.bin')
+    y.tofile(prefix + '_labels.bin')
+
+    patch_shape = X.shape[1:]
+    label_shape = y.shape[1:]
+    ds_x = tf.data.FixedLengthRecordDataset(prefix + '_patches.bin',
+                                            record_bytes=int(np.prod(patch_shape)) * 4)
+    ds_x = ds_x.map(lambda record: tf.reshape(tf.io.decode_raw(record, tf.float32), patch_shape),
+                    num_parallel_calls=tf.data.AUTOTUNE)
+    ds_y = tf.data.FixedLengthRecordDataset(prefix + '_labels.bin',
+                                            record_bytes=int(np.prod(label_shape)) * 4)
+    ds_y = ds_y.map(lambda record: tf.reshape(tf.io.decode_raw(record, tf.float32), label_shape),
+                    num_parallel_calls=tf.data.AUTOTUNE)
+    return tf.data.Dataset.zip((ds_x, ds_y))
+# ----------------------------------------------------------------------------------------------------------------------
 
 
 class TF2DCNN:
@@ -25,7 +142,8 @@ class TF2DCNN:
                  n_bands: int,
                  apply_pca=False,
                  path_to_weights: str = None,
-                 device: str = 'cpu'):
+                 device: str = 'cpu',
+                 devices: Optional[list] = None):
 
         self.train_loss = []
         self.val_loss = []
@@ -36,53 +154,127 @@ class TF2DCNN:
         self.n_bands = n_bands
         self.class_count = n_classes - 1
         self.apply_pca = apply_pca
-        input_shape = (self.n_bands, self.patch_size, self.patch_size)
-
-        C1 = 3 * self.n_bands
-
-        self.model = Sequential()
+        # (source array, projected cube) pair from the last PCA run
+        self._pca_cache = None
+        # whitened (bands, n_bands) projection matrix fit on the first scene
+        self._pca_projection = None
+        # serialized int8 TFLite model produced by export_int8, if any
+        self._tflite_model = None
+        # BN-folded inference function, traced once per set of weights
+        self._infer = None
+
+        if device != 'cpu':
+            if devices is None:
+                # GPU selection moved out of module import so merely importing
+                # this file does not pin CUDA devices for the whole process
+                os.environ.setdefault("CUDA_VISIBLE_DEVICES", "0")
+            # FP16 tensor-core compute with FP32 variable storage; the conv
+            # and dense layers pick the policy up automatically
+            mixed_precision.set_global_policy('mixed_float16')
+        _configure_runtime()
+
+        if device != 'cpu' and (devices is None or len(devices) > 1):
+            # variables built under the strategy scope are mirrored, so the
+            # patch stream fans out over every listed (or visible) GPU
+            self.strategy = tf.distribute.MirroredStrategy(devices)
+        else:
+            self.strategy = tf.distribute.get_strategy()
 
-        self.model.add(Conv2D(C1, (3, 3), activation='relu', input_shape=input_shape))
-        self.model.add(BatchNormalization())
-        self.model.add(Conv2D(3 * C1, (3, 3), activation='relu'))
-        self.model.add(Dropout(0.25))
+        # channels-last: TF's native layout on CPU and the fast cuDNN path,
+        # no implicit transpose in front of each convolution
+        input_shape = (self.patch_size, self.patch_size, self.n_bands)
 
-        self.model.add(Flatten())
-        self.model.add(Dense(6 * self.n_bands, activation='relu'))
-        self.model.add(Dropout(0.5))
-        self.model.add(Dense(self.class_count, activation='softmax'))
+        C1 = 3 * self.n_bands
 
-        sgd = SGD(learning_rate=0.0001,
-                  decay=1e-6,
-                  momentum=0.9,
-                  nesterov=True)
+        with self.strategy.scope():
+            self.model = Sequential()
+
+            self.model.add(Conv2D(C1, (3, 3), activation='relu', data_format='channels_last',
+                                  input_shape=input_shape))
+            self.model.add(BatchNormalization())
+            self.model.add(Conv2D(3 * C1, (3, 3), activation='relu', data_format='channels_last'))
+            self.model.add(Dropout(0.25))
+
+            self.model.add(Flatten())
+            self.model.add(Dense(6 * self.n_bands, activation='relu'))
+            self.model.add(Dropout(0.5))
+            # the softmax output stays float32 for numerical stability under the
+            # mixed_float16 policy
+            self.model.add(Dense(self.class_count, activation='softmax', dtype='float32'))
+
+            # Adam updates each variable in one fused kernel where SGD-with-
+            # momentum ran a mul/add/assign chain; fit can swap the optimizer
+            # through fit_params
+            optimizer = Adam(learning_rate=0.0001)
+            if mixed_precision.global_policy().name == 'mixed_float16':
+                # dynamic loss scaling keeps FP16 gradients from underflowing
+                optimizer = mixed_precision.LossScaleOptimizer(optimizer)
+
+            # XLA fuses the conv/BN/ReLU/dense chain into a couple of kernels;
+            # with 5x5 inputs the step cost is launch overhead, not FLOPs
+            self.model.compile(loss='categorical_crossentropy',
+                               optimizer=optimizer,
+                               metrics=['accuracy'],
+                               jit_compile=True)
 
-        self.model.compile(loss='categorical_crossentropy',
-                           optimizer=sgd,
-                           metrics=['accuracy'])
         if path_to_weights:
             self.model.load_weights(path_to_weights)
     # ------------------------------------------------------------------------------------------------------------------
 
+    def _project_bands(self, X: HSImage) -> np.ndarray:
+        if not self.apply_pca:
+            print('PCA will not apply')
+            return X.data
+        # the projected cube is cached by source array identity so fit
+        # followed by predict on the same scene runs the projection once
+        if self._pca_cache is not None and self._pca_cache[0] is X.data:
+            return self._pca_cache[1]
+        print(f'Will apply PCA from {X.data.shape[-1]} to {self.n_bands}')
+        flat = tf.convert_to_tensor(np.reshape(X.data, (-1, X.data.shape[-1])), dtype=tf.float32)
+        flat -= tf.reduce_mean(flat, axis=0, keepdims=True)
+        if self._pca_projection is None:
+            # snapshot PCA like apply_pca, but in TF: the covariance is only
+            # (bands, bands) so eigh is cheap, and the big (H * W, bands)
+            # matmuls run on GPU BLAS when a GPU is visible. Whitening folds
+            # into the projection matrix, so later scenes reuse the fitted
+            # components with a single matmul
+            cov = tf.matmul(flat, flat, transpose_a=True) / float(flat.shape[0] - 1)
+            eig_vals, eig_vecs = tf.linalg.eigh(cov)
+            components = eig_vecs[:, ::-1][:, :self.n_bands]
+            scales = tf.sqrt(eig_vals[::-1][:self.n_bands])
+            self._pca_projection = components / scales
+        data = tf.matmul(flat, self._pca_projection).numpy()
+        data = data.reshape(X.data.shape[0], X.data.shape[1], self.n_bands)
+        self._pca_cache = (X.data, data)
+        return data
+    # ------------------------------------------------------------------------------------------------------------------
+
     def fit(self,
             X: HSImage,
             y: HSMask,
             fit_params: Dict):
 
-        if self.apply_pca:
-            X = copy.deepcopy(X)
-            X.data, _ = apply_pca(X.data, self.n_bands)
-        else:
-            print('PCA will not apply')
+        data = self._project_bands(X)
 
         fit_params.setdefault('epochs', 10)
         fit_params.setdefault('train_sample_percentage', 0.5)
         fit_params.setdefault('batch_size', 32)
-        # ToDo: add setdefault for optimizer, optimizer params and loss as in other models fit
+        fit_params.setdefault('optimizer', None)
+        fit_params.setdefault('patch_buffer_dir', None)
         fit_params.setdefault('scheduler_type', None)
         fit_params.setdefault('scheduler_params', None)
 
-        X_train, X_val, y_train, y_val = preprocess_data(X=X.data,
+        if fit_params['optimizer'] is not None:
+            with self.strategy.scope():
+                optimizer = fit_params['optimizer']
+                if mixed_precision.global_policy().name == 'mixed_float16':
+                    optimizer = mixed_precision.LossScaleOptimizer(optimizer)
+                self.model.compile(loss='categorical_crossentropy',
+                                   optimizer=optimizer,
+                                   metrics=['accuracy'],
+                                   jit_compile=True)
+
+        X_train, X_val, y_train, y_val = preprocess_data(X=data,
                                                          y=y.get_2d(),
                                                          train_sample_percentage=fit_params['train_sample_percentage'],
                                                          patch_size=5)
@@ -90,71 +282,176 @@ class TF2DCNN:
         print(f'X_train shape: {np.shape(X_train)}, y_train shape: {np.shape(y_train)}')
         print(f'X_val shape: {np.shape(X_val)}, y_val shape: {np.shape(y_val)}')
 
-        train_generator = get_data_generator(X=X_train,
-                                             y=y_train,
-                                             epochs=fit_params['epochs'])
-
-        val_generator = get_data_generator(X=X_val,
-                                           y=y_val,
-                                           epochs=fit_params['epochs'])
-
-        types = (tf.float32, tf.int32)
-        shapes = ((self.n_bands, self.patch_size, self.patch_size), (self.class_count,))
-
-        ds_train = tf.data.Dataset.from_generator(lambda: train_generator, types, shapes).batch(fit_params['batch_size'])
-        ds_val = tf.data.Dataset.from_generator(lambda: val_generator, types, shapes).batch(fit_params['batch_size'])
-
-        steps = len(y_train) / fit_params['batch_size']
-        val_steps = len(y_val) / fit_params['batch_size']
+        # every replica consumes a per-device batch, so the global batch
+        # handed to tf.data scales with the replica count
+        batch_size = fit_params['batch_size'] * self.strategy.num_replicas_in_sync
+
+        if fit_params['patch_buffer_dir'] is not None:
+            # scenes whose patch store would not fit in RAM stream from raw
+            # buffer files instead of in-memory tensors
+            buffer_dir = fit_params['patch_buffer_dir']
+            os.makedirs(buffer_dir, exist_ok=True)
+            ds_train = _raw_patch_dataset(os.path.join(buffer_dir, 'train'), X_train, y_train)
+            ds_val = _raw_patch_dataset(os.path.join(buffer_dir, 'val'), X_val, y_val)
+        else:
+            # the patches are already materialized arrays, so tensor-slices
+            # datasets keep batching and shuffling inside the tf.data graph
+            # instead of pulling every patch through a Python generator
+            ds_train = tf.data.Dataset.from_tensor_slices((X_train.astype(np.float32),
+                                                           y_train.astype(np.float32)))
+            ds_val = tf.data.Dataset.from_tensor_slices((X_val.astype(np.float32),
+                                                         y_val.astype(np.float32)))
+
+        ds_train = ds_train.shuffle(8192).batch(batch_size).prefetch(tf.data.AUTOTUNE)
+        ds_val = ds_val.batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+        # the order batches come off the pipeline does not matter for SGD,
+        # so let tf.data trade determinism for throughput; the datasets are
+        # in-memory, so replicas shard by data rather than by (absent) files
+        options = tf.data.Options()
+        options.deterministic = False
+        options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.DATA
+        ds_train = ds_train.with_options(options)
+        ds_val = ds_val.with_options(options)
 
         checkpoint_filepath = './tmp/checkpoint'
 
         if not os.path.exists(checkpoint_filepath):
             os.makedirs(checkpoint_filepath)
 
-        history = self.model.fit(ds_train,
-                                 validation_data=ds_val,
-                                 validation_steps=val_steps,
-                                 validation_batch_size=fit_params['batch_size'],
-                                 batch_size=fit_params['batch_size'],
-                                 epochs=fit_params['epochs'],
-                                 steps_per_epoch=steps,
-                                 verbose=1)
-
-        self.train_loss = history.history.get('loss', [])
-        self.val_loss = history.history.get('val_loss', [])
-        self.train_accs = history.history.get('accuracy', [])
-        self.val_accs = history.history.get('val_accuracy', [])
-
-        self.model.save(f'{checkpoint_filepath}/weights.h5')
-    # ------------------------------------------------------------------------------------------------------------------
+        history = _HistoryArray(fit_params['epochs'])
 
-    def predict(self,
-                X: HSImage,
-                y: Optional[HSMask] = None) -> np.ndarray:
+        # both datasets are finite, so Keras infers the step counts itself
+        self.model.fit(ds_train,
+                       validation_data=ds_val,
+                       epochs=fit_params['epochs'],
+                       verbose=1,
+                       callbacks=[history])
 
-        if self.apply_pca:
-            X = copy.deepcopy(X)
-            X.data, _ = apply_pca(X.data, self.n_bands)
-        else:
-            print('PCA will not apply')
+        self.train_loss = history.train_loss
+        self.val_loss = history.val_loss
+        self.train_accs = history.train_accs
+        self.val_accs = history.val_accs
+
+        # the weights changed, so the folded inference trace and any int8
+        # export are stale
+        self._infer = None
+        self._tflite_model = None
+
+        # the native .keras format writes contiguous binary weight buffers
+        # instead of serializing tensors one-by-one through the legacy HDF5 path
+        self.model.save(f'{checkpoint_filepath}/weights.keras')
+    # ------------------------------------------------------------------------------------------------------------------
 
-        types = tf.float32
-        shapes = (self.n_bands, self.patch_size, self.patch_size)
-        X = X.data
+    def save_fp16(self,
+                  path: str):
+        """
+        Writes every model weight as float16 through np.savez_compressed,
+        halving checkpoint size and load I/O. Deployment-only: training
+        keeps its full-precision .keras checkpoints, since fp16 storage
+        rounds the FP32 master weights
+        """
+        weights = {f'w{i}': w.astype(np.float16) for i, w in enumerate(self.model.get_weights())}
+        np.savez_compressed(path, **weights)
+    # ------------------------------------------------------------------------------------------------------------------
 
-        test_generator = get_test_generator(X, patch_size=self.patch_size)
-        ds_test = tf.data.Dataset.from_generator(lambda: test_generator, types, shapes).batch(128)
+    def load_fp16(self,
+                  path: str):
+        with np.load(path) as weights:
+            self.model.set_weights([weights[f'w{i}'].astype(np.float32)
+                                    for i in range(len(weights.files))])
+        self._infer = None
+        self._tflite_model = None
+    # ------------------------------------------------------------------------------------------------------------------
 
-        # TODO bad issue
-        total = sum([1 for i in ds_test])
+    def export_int8(self,
+                    rep_data_gen) -> bytes:
+        """
+        Post-training quantization of the trained model to int8 via TFLite.
+        rep_data_gen must yield lists with one float32 (1, 5, 5, bands) patch
+        at a time; the converter calibrates activation ranges on it. Weights
+        drop to a quarter of their fp32 size and inference dispatches to the
+        TFLite interpreter on the next predict call. Input and output stay
+        float32 at the interface, so the patch pipeline is unchanged
+        """
+        converter = tf.lite.TFLiteConverter.from_keras_model(self.model)
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = rep_data_gen
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        self._tflite_model = converter.convert()
+        return self._tflite_model
+    # ------------------------------------------------------------------------------------------------------------------
 
-        test_generator = get_test_generator(X, patch_size=self.patch_size)
-        ds_test = tf.data.Dataset.from_generator(lambda: test_generator, types, shapes).batch(128)
+    def _tflite_logits(self, ds_test):
+        interpreter = tf.lite.Interpreter(model_content=self._tflite_model,
+                                          num_threads=os.cpu_count())
+        inp = interpreter.get_input_details()[0]
+        out = interpreter.get_output_details()[0]
+        allocated = None
+        for batch in ds_test:
+            batch = batch.numpy()
+            # one resize for the full batch shape, one for the ragged tail
+            if batch.shape != allocated:
+                interpreter.resize_tensor_input(inp['index'], batch.shape)
+                interpreter.allocate_tensors()
+                allocated = batch.shape
+            interpreter.set_tensor(inp['index'], batch)
+            interpreter.invoke()
+            yield interpreter.get_tensor(out['index'])
+    # ------------------------------------------------------------------------------------------------------------------
 
-        prediction = self.model.predict(ds_test, steps=total)
-        pr = np.argmax(prediction, axis=1)
-        predicted_mask = np.reshape(pr, (X.shape[0], X.shape[1]))
+    def predict(self,
+                X: HSImage,
+                y: Optional[HSMask] = None,
+                batch_size: int = 1024) -> np.ndarray:
+
+        # large batches amortize launch overhead over the tiny 5x5 patches;
+        # rounded up to a multiple of 8 to keep tensor-core tiles full
+        batch_size = ((batch_size + 7) // 8) * 8
+
+        X = self._project_bands(X)
+
+        # one fused graph op extracts every 5x5 patch; 'SAME' zero-pads the
+        # borders exactly like the old pad_with_zeros + sliding-window path,
+        # so one patch comes out per pixel of the scene
+        patches = tf.image.extract_patches(images=tf.convert_to_tensor(X[None], dtype=tf.float32),
+                                           sizes=[1, self.patch_size, self.patch_size, 1],
+                                           strides=[1, 1, 1, 1],
+                                           rates=[1, 1, 1, 1],
+                                           padding='SAME')
+        patches = tf.reshape(patches, (-1, self.patch_size, self.patch_size, X.shape[2]))
+        ds_test = tf.data.Dataset.from_tensor_slices(patches).batch(batch_size).prefetch(tf.data.AUTOTUNE)
+
+        if self._tflite_model is not None:
+            logits_iter = self._tflite_logits(ds_test)
+        else:
+            if self._infer is None:
+                # fold BN once per set of weights and trace a single jitted
+                # inference function with the batch dimension left free, so
+                # the full batches and the ragged tail share one
+                # specialization and repeat predict calls skip the rebuild.
+                # A direct call also avoids model.predict's per-batch
+                # callback and progbar machinery, which outweighs the
+                # sub-millisecond batches here
+                net = _fold_batchnorm(self.model)
+                signature = [tf.TensorSpec([None, self.patch_size, self.patch_size, self.n_bands],
+                                           tf.float32)]
+                self._infer = tf.function(lambda x: net(x, training=False),
+                                          input_signature=signature,
+                                          jit_compile=True)
+            logits_iter = (self._infer(batch).numpy() for batch in ds_test)
+
+        # argmax each batch of logits straight into slices of one preallocated
+        # index buffer, so the full probability matrix is never materialized
+        # (np.argmax only writes to intp outputs, hence not int32)
+        pr = np.empty(X.shape[0] * X.shape[1], dtype=np.intp)
+        i = 0
+        for logits in logits_iter:
+            n = len(logits)
+            np.argmax(logits, axis=1, out=pr[i:i + n])
+            i += n
+
+        predicted_mask = pr.reshape(X.shape[0], X.shape[1])
 
         return predicted_mask + 1
     # ------------------------------------------------------------------------------------------------------------------